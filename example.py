@@ -13,7 +13,8 @@ tree, namespaces, blogs, authors, tags, posts, attachments = extract_blog_from_X
 # Open LaTeX file:
 if not os.path.exists('texOutput'): os.mkdir('texOutput')
 filename = "texOutput/Blog.tex"
-f = open(filename, 'w')
+# Large write buffer, so that the many small writes per post are flushed to disk in few chunks:
+f = open(filename, 'w', buffering=1<<20)
 
 # Define title and author:
 abstract = "Carrots are devine... You get a dozen for a dime, It's maaaa-gic!"
@@ -14,27 +14,93 @@ Author: R. L. Bailey (GitHub bairaelyn), April-May 2020.
 import subprocess
 import os
 import re
+import struct
 from datetime import datetime
+from functools import lru_cache
 import pytz
 
 try:
     import get_image_size
 except:
+    get_image_size = None
     print("get_image_size not installed. Image sizes may not be read correctly.")
 
 nl = "\n"
 horizontal_rule = '\\noindent\\rule{\\textwidth}{0.4pt}\\vspace{2.5mm}'
 
+# Ordinal suffixes for days of the month, indexed by day:
+_DAY_SUFFIX = ['th']*32
+_DAY_SUFFIX[1] = _DAY_SUFFIX[21] = _DAY_SUFFIX[31] = 'st'
+_DAY_SUFFIX[2] = _DAY_SUFFIX[22] = 'nd'
+_DAY_SUFFIX[3] = _DAY_SUFFIX[23] = 'rd'
+
+# Precompiled regex patterns, reused for every post:
+_TAGS_RE = re.compile('<(em|i|strong|li)>(.+?)</\\1>|<span(.+?)</span>')
+_IMG_RE = re.compile('<img(.+?)>')
+_IMG_WP_RE = re.compile('<!-- wp:image (.+?)-->\n(.+?)\n<!-- /wp:image -->')
+_SRC_RE = re.compile('src="(.+?)"')
+_FIGCAPTION_RE = re.compile('<figcaption>(.+?)</figcaption>')
+_FIG_FIX_RE = re.compile(r'end{figure}(\n?) \[\\ref{fig:(\d+)}]')
+_FIG_REF_RE = re.compile(r'\[\\ref{fig:(\d+)}]')
+# Link text is kept to one line: images inside links have already become figures
+# by the time urls_to_latex runs, and a float can't go in \href's argument:
+_A_HREF_RE = re.compile(r'<a\s+href="(?P<url>[^"]+)"[^>]*>(?P<des>[^\n]*?)</a>')
+# Block attributes are kept to the comment line. Contents may span several lines,
+# but never cross another block comment, so a malformed block can't swallow the next:
+_WP_BLOCK_BODY = '((?:(?!<!-- /?wp:).)*?)'
+_WP_PARAGRAPH_RE = re.compile('<!-- wp:paragraph [^\n]*?-->\n<p[^>]*>'+_WP_BLOCK_BODY+'</p>\n<!-- /wp:paragraph -->', re.DOTALL)
+_WP_LIST_RE = re.compile('<!-- wp:list [^\n]*?-->\n'+_WP_BLOCK_BODY+'\n<!-- /wp:list -->', re.DOTALL)
+_WP_VIDEO_RE = re.compile('<!-- wp:video [^\n]*?-->\n'+_WP_BLOCK_BODY+'\n<!-- /wp:video -->', re.DOTALL)
+
+# LaTeX (start, end) strings for the HTML tags in _TAGS_RE:
+_TAG_LATEX = {
+    'em': ('\\textit{', '}'),
+    'i': ('\\emph{', '}'),
+    'strong': ('\\textbf{', '}'),
+    'li': ('\\item ', ''),
+}
+
+# Plain string substitutions done in post_to_latex:
+_SIMPLE_SUBS = {
+    '<br>': nl,
+    '<hr />': '',
+    '<hr>': horizontal_rule,
+    '<ul>': '\\begin{itemize}',
+    '</ul>': '\\end{itemize}',
+}
+_SIMPLE_RE = re.compile('|'.join(re.escape(k) for k in _SIMPLE_SUBS))
+_NL3_RE = re.compile('\n{3,}')
+
+# Single-character symbol replacements done in symbols_to_latex:
+_SYM_TABLE = str.maketrans({
+    '€': '\\euro',
+    '¥': ' yen',
+    '$': '\\$',
+    '°': '$^\\circ$',
+    '#': '\\#',
+    '%': '\\%',
+    '&': '\\&',
+})
+
+# Media archive file indices, keyed by archive path:
+_media_index_cache = {}
+# Image orientations (True for landscape), keyed by (path, modification time):
+_orient_cache = {}
+
 # -------------------------------------------------------------------
 # GENERAL LATEX TEXT FUNCTIONS
 # -------------------------------------------------------------------
 
 def date_string(date):
-    if 4 <= date.day <= 20 or 24 <= date.day <= 30:
-        suffix = "th"
-    else:
-        suffix = ["st", "nd", "rd"][date.day % 10 - 1]
-    datef = datetime.strftime(date, "{}{} %b %Y, %H:%M.".format(date.day, suffix))
+    return _date_string(date.year, date.month, date.day, date.hour, date.minute)
+
+
+@lru_cache(maxsize=4096)
+def _date_string(year, month, day, hour, minute):
+    """Cached by date fields rather than the datetime itself, as datetimes in different
+    timezones can compare (and hash) equal."""
+    date = datetime(year, month, day, hour, minute)
+    datef = "{}{} {}.".format(day, _DAY_SUFFIX[day], datetime.strftime(date, "%b %Y, %H:%M"))
     datestr = "\\textit{Published on "+datef+"}"+nl
 
     return datestr
@@ -47,63 +113,65 @@ def latex_preamble(f, title, author, abstract):
     Takes f, an open .tex file, and strings for title, author, abstract.
     """
 
-    f.write("\\documentclass[10pt,twoside,openright]{memoir}"+nl)
-    f.write("\\usepackage{graphicx}"+nl)
-    f.write("\\usepackage{hyperref}"+nl)
-    f.write("\\usepackage{eurosym}"+nl)
-    f.write("\\usepackage{subcaption}"+nl)
-    f.write("\\usepackage{cleveref}"+nl)
-    f.write("\\captionsetup[subfigure]{subrefformat=simple,labelformat=simple}"+nl)
-    f.write("\\renewcommand\\thesubfigure{(\\alph{subfigure})}"+nl)
-    f.write("\\setlrmarginsandblock{0.12\\paperwidth}{*}{1}"+nl)
-    f.write("\\setulmarginsandblock{0.15\\paperwidth}{*}{1}"+nl)
-    f.write("\\checkandfixthelayout"+nl)
-    f.write(nl)
-    f.write("\\pagestyle{ruled}"+nl)
-    f.write(nl)
-    f.write("% Makes a fancier chapter style:"+nl)
-    f.write("\\setlength\\midchapskip{10pt}"+nl)
-    f.write("  \\makechapterstyle{VZ23}{"+nl)
-    f.write("  \\renewcommand\\chapternamenum{}"+nl)
-    f.write("  \\renewcommand\\printchaptername{}"+nl)
-    f.write("  \\renewcommand\\chapnumfont{\\Huge\\bfseries\\centering}"+nl)
-    f.write("  \\renewcommand\\chaptitlefont{\\Huge\\scshape\\centering}"+nl)
-    f.write("  \\renewcommand\\afterchapternum{%"+nl)
-    f.write("    \\par\\nobreak\\vskip\\midchapskip\\hrule\\vskip\\midchapskip}"+nl)
-    f.write("  \\renewcommand\\printchapternonum{%"+nl)
-    f.write("    \\vphantom{\\chapnumfont \\thechapter}"+nl)
-    f.write("    \\par\\nobreak\\vskip\\midchapskip\\hrule\\vskip\\midchapskip}"+nl)
-    f.write("}"+nl)
-    f.write("\\chapterstyle{VZ23}"+nl)
-    f.write(nl)
-    f.write("% Removes section numberings:"+nl)
-    f.write("\\setcounter{secnumdepth}{0}"+nl)
-    f.write(nl)
-    f.write("% Removes abstract title:"+nl)
-    f.write("\\renewcommand{\\abstractname}{\\vspace{-\\baselineskip}}"+nl)
-    f.write(nl)
-    f.write("\\begin{document}"+nl)
-    f.write(nl)
-    f.write("\\font\\myfont=cmr12 at 35pt"+nl)
-    f.write("\\title{{\\myfont "+title+"}}"+nl)
-    f.write("\\author{\\textit{"+author+"}}"+nl)
-    f.write(nl)
-    f.write("\\maketitle"+nl)
-    f.write(nl)
-    f.write("\\begin{abstract}"+nl)
-    f.write(abstract+nl)
-    f.write("\\end{abstract}"+nl)
-    f.write(nl)
-    f.write("\\newpage"+nl)
-    f.write("\\tableofcontents"+nl)
-    f.write(nl)
+    lines = [
+        "\\documentclass[10pt,twoside,openright]{memoir}",
+        "\\usepackage{graphicx}",
+        "\\usepackage{hyperref}",
+        "\\usepackage{eurosym}",
+        "\\usepackage{subcaption}",
+        "\\usepackage{cleveref}",
+        "\\captionsetup[subfigure]{subrefformat=simple,labelformat=simple}",
+        "\\renewcommand\\thesubfigure{(\\alph{subfigure})}",
+        "\\setlrmarginsandblock{0.12\\paperwidth}{*}{1}",
+        "\\setulmarginsandblock{0.15\\paperwidth}{*}{1}",
+        "\\checkandfixthelayout",
+        "",
+        "\\pagestyle{ruled}",
+        "",
+        "% Makes a fancier chapter style:",
+        "\\setlength\\midchapskip{10pt}",
+        "  \\makechapterstyle{VZ23}{",
+        "  \\renewcommand\\chapternamenum{}",
+        "  \\renewcommand\\printchaptername{}",
+        "  \\renewcommand\\chapnumfont{\\Huge\\bfseries\\centering}",
+        "  \\renewcommand\\chaptitlefont{\\Huge\\scshape\\centering}",
+        "  \\renewcommand\\afterchapternum{%",
+        "    \\par\\nobreak\\vskip\\midchapskip\\hrule\\vskip\\midchapskip}",
+        "  \\renewcommand\\printchapternonum{%",
+        "    \\vphantom{\\chapnumfont \\thechapter}",
+        "    \\par\\nobreak\\vskip\\midchapskip\\hrule\\vskip\\midchapskip}",
+        "}",
+        "\\chapterstyle{VZ23}",
+        "",
+        "% Removes section numberings:",
+        "\\setcounter{secnumdepth}{0}",
+        "",
+        "% Removes abstract title:",
+        "\\renewcommand{\\abstractname}{\\vspace{-\\baselineskip}}",
+        "",
+        "\\begin{document}",
+        "",
+        "\\font\\myfont=cmr12 at 35pt",
+        "\\title{{\\myfont "+title+"}}",
+        "\\author{\\textit{"+author+"}}",
+        "",
+        "\\maketitle",
+        "",
+        "\\begin{abstract}",
+        abstract,
+        "\\end{abstract}",
+        "",
+        "\\newpage",
+        "\\tableofcontents",
+        "",
+    ]
+    f.write(nl.join(lines)+nl)
 
 
 def new_chapter(f, title):
     """Parameters f, and open .tex file and the string title for new chapter."""
 
-    f.write("\\chapter{"+title+"}"+nl)
-    f.write(nl)
+    f.write("\\chapter{"+title+"}"+nl+nl)
 
 # -------------------------------------------------------------------
 # CONVERTING XML TO LATEX
@@ -112,25 +180,40 @@ def new_chapter(f, title):
 def html_tags_to_latex(textbody):
     """Replaces HTML tags with LaTeX equivalents within textbody.
     """
-    for s in re.finditer('<em>(.+?)</em>', textbody):
-        emphstr = s.group(0)
-        textbody = textbody.replace(emphstr, "\\textit{"+s.group(1)+"}")
-    for s in re.finditer('<i>(.+?)</i>', textbody):
-        emphstr = s.group(0)
-        textbody = textbody.replace(emphstr, "\\emph{"+s.group(1)+"}")
-    for s in re.finditer('<strong>(.+?)</strong>', textbody):
-        boldstr = s.group(0)
-        textbody = textbody.replace(boldstr, "\\textbf{"+s.group(1)+"}")
-    for s in re.finditer('<li>(.+?)</li>', textbody):
-        itemstr = s.group(0)
-        textbody = textbody.replace(itemstr, "\\item "+s.group(1))
-    for s in re.finditer('<span(.+?)</span>', textbody):
-        itemstr = s.group(0)
-        textbody = textbody.replace(itemstr, '')
+    if '<' not in textbody:
+        return textbody
+
+    textbody = _TAGS_RE.sub(_tag_to_latex, textbody)
 
     return textbody
 
 
+def _tag_to_latex(s):
+    """Returns the LaTeX for one match of _TAGS_RE. Spans are removed entirely,
+    other tags are converted with their (converted) content."""
+    if s.group(1) is None:
+        return ''
+    start, end = _TAG_LATEX[s.group(1)]
+
+    return start+html_tags_to_latex(s.group(2))+end
+
+
+class _Figure:
+    """Holds everything image_to_latex needs to know about one image in textbody.
+    setup is 1 for a single figure, 0/2 for the first/second image of a pair.
+    after_nl is True if imgstr follows an empty line (nl+nl) in textbody."""
+    __slots__ = ('imgstr', 'fignum', 'figpath', 'figcaption', 'landscape', 'setup', 'after_nl')
+
+    def __init__(self, imgstr, fignum, figpath, figcaption='', landscape=None, setup=1, after_nl=False):
+        self.imgstr = imgstr
+        self.fignum = fignum
+        self.figpath = figpath
+        self.figcaption = figcaption
+        self.landscape = landscape
+        self.setup = setup
+        self.after_nl = after_nl
+
+
 def image_to_latex(textbody, media_archive, figcounter, fws=['0.5','0.4'], layout='optimal', wp_blocks=False):
     """Replaces image references in textbody with LaTeX figure/subfigure code.
     Original image string looks like this:
@@ -162,177 +245,252 @@ def image_to_latex(textbody, media_archive, figcounter, fws=['0.5','0.4'], layou
         Textbody with LaTeX figures replaced, current figcounter to continue to next post.
     """
 
-    img_paths = []
-    # r=root, d=directories, f= files
-    for r, d, f in os.walk(media_archive):
-        for file in f:
-            img_paths.append(os.path.join(r, file))
+    # Nothing to do for text-only posts, skip indexing the media archive:
+    if '<img' not in textbody:
+        return textbody, figcounter
+
+    img_paths = _media_index(media_archive)
 
     landscape = [-1]
     replacestr = {}
-    allimgstr, fignums, figpaths, figcaptions, orient = [], [], [], [], []
+    figs = []
     str_fig, figpath, figcaption = '', '', ''
     lastimgstr = '----'
-    figsetup = []
     if wp_blocks == False:
-        re_img_str = '<img(.+?)>'
+        re_img = _IMG_RE
     else:
-        re_img_str = '<!-- wp:image (.+?)-->\n(.+?)\n<!-- /wp:image -->'
+        re_img = _IMG_WP_RE
 
-    for s in re.finditer(re_img_str, textbody):
+    for s in re_img.finditer(textbody):
         laststr, lastfigpath, lastfigcaption = str_fig, figpath, figcaption
         img_exists = False
-        try:
-            n = re.search('src="(.+?)"', s.group(0)).group(1)
-            nfile = os.path.split(n)[-1].split('?')[0]
-            figpath = [x for x in img_paths if nfile in x][0]
-            img_exists = True
-        except:
+        src = _SRC_RE.search(s.group(0))
+        if src is not None:
+            nfile = os.path.split(src.group(1))[-1].split('?')[0]
+            imgpath = img_paths.get(nfile) or next((x for x in img_paths.values() if nfile in x), None)
+            if imgpath is not None:
+                figpath = imgpath
+                img_exists = True
+        if not img_exists:
             print("ERROR finding image regex: {}".format(s.group(0)))
             replacestr[s.group(0)] = ""
-        if img_exists:
-            allimgstr.append(s.group(0))
-            fignums.append(figcounter)
-            figpaths.append(figpath)
-            try:
-                figwidth, figheight = get_image_size.get_image_size(figpath)
-            except:
-                figwidth, figheight = jpeg_res(figpath)
-            try:
-                figcaption = re.search('<figcaption>(.+?)</figcaption>', s.group(0)).group(1)
-            except: # no captions
-                figcaption = ''
-            figcaptions.append(figcaption)
+        else:
+            # Check once whether the image string starts after an empty line:
+            after_nl = textbody[s.start()-2:s.start()] == nl+nl
+            fig = _Figure(s.group(0), figcounter, figpath, after_nl=after_nl)
+            figs.append(fig)
+            is_landscape = _is_landscape(figpath)
+            caption = _FIGCAPTION_RE.search(s.group(0))
+            figcaption = caption.group(1) if caption is not None else ''
+            fig.figcaption = figcaption
 
             # SINGLE FIGURE LAYOUT
             # --------------------
             if layout == 'single':
-                if figwidth > figheight:
+                if is_landscape:
                     sfigtw = fws[0]
                 else:
                     sfigtw = fws[1]
                 str_fig = _include_figure(figpath, figcounter, figcaption, figwidth=sfigtw)
-                figsetup.append(1)
 
             # OPTIMAL/PAIRED FIGURE LAYOUT
             # ----------------------------
             if layout in ['optimal', 'paired']:
-                if figwidth > figheight:
-                    landscape.append(True)
-                    orient.append(True)
-                else:
-                    landscape.append(False)
-                    orient.append(False)
+                fig.landscape = is_landscape
+                landscape.append(fig.landscape)
 
                 if landscape[-2] == landscape[-1]:
-                    if orient[-1] == True:
+                    if fig.landscape == True:
                         figtw = '0.45'
                     else:
                         figtw = fws[1]
                     str_fig = _include_subfigures(lastfigpath, figpath, figcounter-1, figcounter,
                                                   lastfigcaption, figcaption, figtw, figtw)
                     landscape[-1] = -1
-                    if nl+nl+lastimgstr in textbody:
+                    if figs[-2].after_nl:
                         replacestr[nl+nl+lastimgstr] = " [\\ref{fig:"+str(figcounter-1)+"}]"
                     else:
                         replacestr[lastimgstr] = " [\\ref{fig:"+str(figcounter-1)+"}]"
-                    figsetup[-1] = 0
-                    figsetup.append(2)
+                    figs[-2].setup = 0
+                    fig.setup = 2
                 else:
                     if landscape[-1] == True:
                         sfigtw = fws[0]
                     else:
                         sfigtw = fws[1]
                     str_fig = _include_figure(figpath, figcounter, figcaption, figwidth=sfigtw)
-                    figsetup.append(1)
 
             # Defining the fig strings to replace img strings with:
             lastimgstr = s.group(0)
-            if nl+nl+lastimgstr in textbody:
+            if fig.after_nl:
                 replacestr[nl+nl+lastimgstr] = " [\\ref{fig:"+str(figcounter)+"}]"+nl+nl+str_fig
             else:
                 replacestr[lastimgstr] = " [\\ref{fig:"+str(figcounter)+"}]"+nl+nl+str_fig
-            #print('-------------'+str(figcounter)+'-'+str(figsetup[-1]))
+            #print('-------------'+str(figcounter)+'-'+str(fig.setup))
             #print(str_fig)
             figcounter = figcounter + 1
 
     # This is the last fix to pair up leftover images in optimal:
     if layout == 'optimal':
         if len(replacestr) != 0:
-            loopfigs = figsetup+[-1]
-            for ifig, fignum in enumerate(loopfigs):
-                if loopfigs[ifig] == 1 and loopfigs[ifig+1] == 1:
-                    if orient[ifig] == True:
-                        figtw1, figtw2 = fws[0], fws[1]
-                    else:
-                        figtw1, figtw2 = fws[1], fws[0]
-                    #print('********', fignum, figpaths[ifig], figpaths[ifig+1], fignums[ifig], ifig)
-                    str_fig = _include_subfigures(figpaths[ifig], figpaths[ifig+1], fignums[ifig], fignums[ifig+1],
-                                                  figcaptions[ifig], figcaptions[ifig+1], figtw1, figtw2)
-                    if nl+nl+lastimgstr in textbody:
-                        replacestr[nl+nl+allimgstr[ifig]] = " [\\ref{fig:"+str(fignums[ifig])+"}]"
-                    else:
-                        replacestr[allimgstr[ifig]] = " [\\ref{fig:"+str(fignums[ifig])+"}]"
-                    replacestr[nl+nl+allimgstr[ifig+1]] = " [\\ref{fig:"+str(fignums[ifig+1])+"}]"+nl+nl+str_fig
-                    loopfigs[ifig] = 0
-                    loopfigs[ifig+1] = 2
-                elif loopfigs[ifig+1] == -1:
-                    break
-
-    for key in replacestr:
-        textbody = textbody.replace(key, replacestr[key])
+            for fig1, fig2 in _pair_single_figures(figs):
+                if fig1.landscape == True:
+                    figtw1, figtw2 = fws[0], fws[1]
+                else:
+                    figtw1, figtw2 = fws[1], fws[0]
+                #print('********', fig1.fignum, fig1.figpath, fig2.figpath)
+                str_fig = _include_subfigures(fig1.figpath, fig2.figpath, fig1.fignum, fig2.fignum,
+                                              fig1.figcaption, fig2.figcaption, figtw1, figtw2)
+                if fig1.after_nl:
+                    replacestr[nl+nl+fig1.imgstr] = " [\\ref{fig:"+str(fig1.fignum)+"}]"
+                else:
+                    replacestr[fig1.imgstr] = " [\\ref{fig:"+str(fig1.fignum)+"}]"
+                if fig2.after_nl:
+                    replacestr[nl+nl+fig2.imgstr] = " [\\ref{fig:"+str(fig2.fignum)+"}]"+nl+nl+str_fig
+                else:
+                    replacestr[fig2.imgstr] = " [\\ref{fig:"+str(fig2.fignum)+"}]"+nl+nl+str_fig
 
     if len(replacestr) != 0:
+        # Replace all image strings in one pass. Longer keys go first so that
+        # nl+nl+imgstr takes precedence over imgstr:
+        re_replace = re.compile('|'.join(re.escape(k) for k in sorted(replacestr, key=len, reverse=True)))
+        textbody = re_replace.sub(lambda m: replacestr[m.group(0)], textbody)
+
         # Correct labels that have ended up beneath figures rather in in textbody:
-        for s in re.finditer('end{figure} \[\\\\ref{fig:(.+?)}]', textbody):
-            num = s.group(1)
-            textbody = textbody.replace('[\\ref{fig:'+str(int(num)-1)+'}]', 
-                                '[\\ref{fig:'+str(int(num)-1)+'}] ' + '[\\ref{fig:'+str(int(num))+'}] ')
-            textbody = textbody.replace('[\\ref{fig:'+str(int(num))+'}]', '')
-
-        for s in re.finditer('end{figure}\\n \[\\\\ref{fig:(.+?)}]', textbody):
-            num = s.group(1)
-            textbody = textbody.replace('[\\ref{fig:'+str(int(num)-1)+'}]', 
-                                '[\\ref{fig:'+str(int(num)-1)+'}] ' + '[\\ref{fig:'+str(int(num))+'}] ')
-            textbody = textbody.replace('[\\ref{fig:'+str(int(num))+'}]', '')
+        textbody = _fix_figure_refs(textbody)
 
     return textbody, figcounter
 
 
+def _pair_single_figures(figs):
+    """Pairs up neighbouring figures that are still single (setup == 1), updating
+    their setup. Only the pairing is decided here, returns a list of (fig1, fig2)."""
+    pairs = []
+    for fig1, fig2 in zip(figs[:-1], figs[1:]):
+        if fig1.setup == 1 and fig2.setup == 1:
+            fig1.setup = 0
+            fig2.setup = 2
+            pairs.append((fig1, fig2))
+
+    return pairs
+
+
 def _include_figure(figpath, fignum, figcaption, figwidth=0.5):
     """Fills LaTeX code for figure/image inclusion."""
-    str_fig =  "\\begin{figure}"+nl
-    str_fig += "    \\centering"+nl
-    str_fig += "    \\includegraphics[width="+str(figwidth)+"\\textwidth]{"+figpath+"}"+nl
-    str_fig += "    \\caption{"+figcaption+"}"+nl
-    str_fig += "    \\label{fig:"+str(fignum)+"}"+nl
-    str_fig += "\\end{figure}"
+    str_fig = nl.join([
+        "\\begin{figure}",
+        "    \\centering",
+        "    \\includegraphics[width="+str(figwidth)+"\\textwidth]{"+figpath+"}",
+        "    \\caption{"+figcaption+"}",
+        "    \\label{fig:"+str(fignum)+"}",
+        "\\end{figure}",
+    ])
 
     return str_fig
 
 
 def _include_subfigures(figpath1, figpath2, fignum1, fignum2, figcaption1, figcaption2, fw1, fw2):
     """Fills LaTeX code for figure with two subfigures."""
-    str_fig =  "\\begin{figure}[htbp!]"+nl
-    str_fig += "  \\centering"+nl
-    str_fig += "  \\begin{subfigure}[t]{"+fw1+"\\textwidth}"+nl
-    str_fig += "    \\includegraphics[width=\\textwidth]{"+figpath1+"}"+nl
-    str_fig += "    \\caption{"+figcaption1+"}"+nl
-    str_fig += "    \\label{fig:"+str(fignum1)+"}"+nl
-    str_fig += "  \\end{subfigure}"+nl
-    str_fig += "  \\begin{subfigure}[t]{"+fw2+"\\textwidth}"+nl
-    str_fig += "    \\includegraphics[width=\\textwidth]{"+figpath2+"}"+nl
-    str_fig += "    \\caption{"+figcaption2+"}"+nl
-    str_fig += "    \\label{fig:"+str(fignum2)+"}"+nl
-    str_fig += "  \\end{subfigure}"+nl
-    str_fig += "  \\caption{"+nl
-    str_fig += "  \\label{fig:"+str(fignum1)+"-"+str(fignum2)+"}"+nl
-    str_fig += "  }"+nl
-    str_fig += "\\end{figure}"+nl
+    str_fig = nl.join([
+        "\\begin{figure}[htbp!]",
+        "  \\centering",
+        "  \\begin{subfigure}[t]{"+fw1+"\\textwidth}",
+        "    \\includegraphics[width=\\textwidth]{"+figpath1+"}",
+        "    \\caption{"+figcaption1+"}",
+        "    \\label{fig:"+str(fignum1)+"}",
+        "  \\end{subfigure}",
+        "  \\begin{subfigure}[t]{"+fw2+"\\textwidth}",
+        "    \\includegraphics[width=\\textwidth]{"+figpath2+"}",
+        "    \\caption{"+figcaption2+"}",
+        "    \\label{fig:"+str(fignum2)+"}",
+        "  \\end{subfigure}",
+        "  \\caption{",
+        "  \\label{fig:"+str(fignum1)+"-"+str(fignum2)+"}",
+        "  }",
+        "\\end{figure}",
+        ""
+    ])
 
     return str_fig
 
 
+def _is_landscape(figpath):
+    """Returns True if the image at figpath is wider than high, using get_image_size if
+    available and jpeg_res otherwise. Cached by path and modification time, so images
+    used more than once are only read once."""
+    key = (figpath, os.path.getmtime(figpath))
+    landscape = _orient_cache.get(key)
+    if landscape is None:
+        figwidth, figheight = None, None
+        if get_image_size is not None:
+            try:
+                figwidth, figheight = get_image_size.get_image_size(figpath)
+            except:
+                pass
+        if figwidth is None:
+            figwidth, figheight = jpeg_res(figpath)
+        landscape = figwidth > figheight
+        _orient_cache[key] = landscape
+
+    return landscape
+
+
+def _fix_figure_refs(textbody):
+    """Removes each [\\ref{fig:N}] that ended up beneath a figure (directly after
+    \\end{figure}), and pads [\\ref{fig:N-1}] with two spaces in its place.
+    Labels on the same line as \\end{figure} are handled before those on the next line.
+    All references are then rewritten in a single pass over textbody."""
+    matches = [(s.group(1) == nl, int(s.group(2))) for s in _FIG_FIX_RE.finditer(textbody)]
+    removed, padding = set(), {}
+    for next_line in [False, True]:
+        # Next-line labels already removed by the same-line pass no longer match:
+        skip = set(removed) if next_line else set()
+        for on_next_line, num in matches:
+            if on_next_line != next_line or num in skip:
+                continue
+            if num-1 not in removed:
+                padding[num-1] = padding.get(num-1, '') + '  '
+            removed.add(num)
+    if len(removed) == 0:
+        return textbody
+
+    def _fix(s):
+        num = int(s.group(1))
+        return ('' if num in removed else s.group(0)) + padding.get(num, '')
+
+    return _FIG_REF_RE.sub(_fix, textbody)
+
+
+def _media_index(media_archive):
+    """Returns a dict of file name -> full path for all files in media_archive.
+    The archive is only walked once, later calls return the cached index."""
+    img_paths = _media_index_cache.get(media_archive)
+    if img_paths is None:
+        img_paths = {}
+        for name, path in _walk_files(media_archive):
+            img_paths.setdefault(name, path)
+        _media_index_cache[media_archive] = img_paths
+
+    return img_paths
+
+
+def _walk_files(root):
+    """Yields (file name, full path) for all files below root, in the same order
+    as os.walk. Uses os.scandir, so no extra stat calls are needed per entry."""
+    subdirs = []
+    try:
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file():
+                    yield entry.name, entry.path
+    except OSError: # unreadable or missing directory, skipped like in os.walk
+        return
+    for subdir in subdirs:
+        yield from _walk_files(subdir)
+
+
 def post_to_latex(f, post, figcounter, media_archive='', fig_layout='optimal', end_document=False):
     """Puts the main text body through all the conversions it should
     need to successfully write to a .tex file that can be compiled
@@ -362,13 +520,8 @@ def post_to_latex(f, post, figcounter, media_archive='', fig_layout='optimal', e
     """
 
     newbody = post.body
-    # Replace new lines:
-    newbody = newbody.replace('<br>', nl)
-    if '<br>' in newbody:
-        print("Something's gone very wrong. Be worried, be very worried.")
-    # Replace horizontal rules
-    newbody = newbody.replace('<hr />', '')
-    newbody = newbody.replace('<hr>', horizontal_rule)
+    # Replace new lines, horizontal rules and lists in one pass:
+    newbody = _SIMPLE_RE.sub(lambda m: _SIMPLE_SUBS[m.group(0)], newbody)
     wp_blocks = False
     if '<!-- wp:paragraph -->' in newbody:
         wp_blocks = True
@@ -381,30 +534,19 @@ def post_to_latex(f, post, figcounter, media_archive='', fig_layout='optimal', e
     newbody = symbols_to_latex(newbody)
     # Replace HTML tags:
     newbody = html_tags_to_latex(newbody)
-    # Update lists:
-    newbody = newbody.replace("<ul>", "\\begin{itemize}")
-    newbody = newbody.replace("</ul>", "\\end{itemize}")
     # Remove excessive newlines, but never less than two:
-    newbody = newbody.replace(3*nl, 2*nl).replace(3*nl, 2*nl).replace(3*nl, 2*nl)
+    newbody = _NL3_RE.sub(2*nl, newbody)
     # Fix single-line picture references:
     newbody = newbody.replace(nl+nl+'[\\ref{fig', '[\\ref{fig')
 
-    # Finally write the adjusted text body:
-    f.write("\\section{"+post.title+"}"+nl)
-
     # Add the publication date at the end of the post:
     datestr = date_string(post.post_date)
-    f.write(nl+'\\noindent '+datestr)
-
-    f.write(nl)
-    f.write(newbody+nl)
-
-    #IPython.embed()
-
-    f.write(nl)
 
+    # Finally write the adjusted text body, all in one go:
+    out = ["\\section{", post.title, "}", nl, nl, '\\noindent ', datestr, nl, newbody, nl, nl]
     if end_document:
-        f.write("\\end{document}"+nl)
+        out.append("\\end{document}"+nl)
+    f.write(''.join(out))
 
     return figcounter
 
@@ -414,14 +556,9 @@ def symbols_to_latex(textbody):
     Note: definitely not an exhaustive list.
     """
 
-    textbody = textbody.replace('€', '\\euro')
-    textbody = textbody.replace('¥', ' yen')
-    textbody = textbody.replace('$', '\\$')
-    textbody = textbody.replace('°', '$^\\circ$')
-    textbody = textbody.replace('&lt;', '$<$')
-    textbody = textbody.replace('#', '\\#')
-    textbody = textbody.replace('%', '\\%')
-    textbody = textbody.replace('&', '\\&')
+    textbody = textbody.translate(_SYM_TABLE)
+    # The '&' of '&lt;' has been escaped by now:
+    textbody = textbody.replace('\\&lt;', '$<$')
 
     return textbody
 
@@ -430,60 +567,98 @@ def urls_to_latex(textbody):
     """Replaces HTML-type URLs with LaTeX-friendly format.
     """
 
-    for s in re.finditer('<a href=(.+?)/a>', textbody):
-        url = re.search('"(.+?)"', s.group(0)).group(1)
-        des = re.search('>(.+?)<', s.group(0)).group(1)
-        #str_url = "\\begin{center}"+nl+"\\href{"+url+"}{"+des+"}"+nl+"\\end{center}"+nl
-        str_url = "\\href{"+url+"}{"+des+"}"+nl
-        textbody = textbody.replace(s.group(0), str_url)
+    if 'href=' not in textbody:
+        return textbody
+
+    textbody = _A_HREF_RE.sub(_url_to_latex, textbody)
 
     return textbody
 
 
+def _url_to_latex(s):
+    """Returns the LaTeX for one match of _A_HREF_RE, links without text show the URL."""
+    url, des = s.group('url'), s.group('des') or s.group('url')
+
+    return "\\href{"+url+"}{"+des+"}"+nl
+
+
 def wp_blocks_to_latex(textbody):
 
-    # Paragraph block:
-    textbody = textbody.replace('<!-- wp:paragraph -->\n<p></p>\n<!-- /wp:paragraph -->', '')
-    for s in re.finditer('<!-- wp:paragraph(.+?)-->\n<(.+?)>(.+?)</p>\n<!-- /wp:paragraph -->', textbody):
-        parstr = s.group(0)
-        textbody = textbody.replace(parstr, s.group(3))
+    # Paragraph block (empty paragraphs are removed):
+    textbody = _WP_PARAGRAPH_RE.sub(lambda s: s.group(1), textbody)
     # List:
-    for s in re.finditer('<!-- wp:list(.+?)-->\n(.+?)\n<!-- /wp:list -->', textbody):
-        liststr = s.group(0)
-        textbody = textbody.replace(liststr, s.group(2))
+    textbody = _WP_LIST_RE.sub(lambda s: s.group(1), textbody)
     # Horizontal rule:
     textbody = textbody.replace('<!-- wp:separator -->\n<hr class="wp-block-separator" />\n<!-- /wp:separator -->',
                                 horizontal_rule)
     # Video block:
-    for s in re.finditer('<!-- wp:video(.+?)-->\n(.+?)\n<!-- /wp:video -->', textbody):
-        link = re.search('src="(.+?)"', s.group(0)).group(1)
-        str_url = "\\href{"+link+"}{Link to Video.}"+nl
-        textbody = textbody.replace(s.group(0), str_url)
+    textbody = _WP_VIDEO_RE.sub(_video_to_latex, textbody)
 
     return textbody
 
 
+def _video_to_latex(s):
+    """Returns a link for one match of _WP_VIDEO_RE, videos without a src are left unchanged."""
+    link = _SRC_RE.search(s.group(1))
+    if link is None:
+        return s.group(0)
+
+    return "\\href{"+link.group(1)+"}{Link to Video.}"+nl
+
+
 # -------------------------------------------------------------------
 # OTHER USEFUL FUNCTIONS
 # -------------------------------------------------------------------
 
 def jpeg_res(filename):
-   """"This function prints the resolution of the jpeg image file passed into it
+   """"This function returns the resolution (width, height) of the jpeg image file passed into it.
+   The size is read from the first SOFn (start of frame) segment. Returns (0, 0) if none is found.
+   Results are cached per filename and modification time, so repeated images are only read once.
    """
 
+   return _jpeg_res(filename, os.path.getmtime(filename))
+
+
+@lru_cache(maxsize=None)
+def _jpeg_res(filename, mtime):
+   """Does the reading for jpeg_res, mtime is only part of the cache key."""
+
    # open image for reading in binary mode
    with open(filename,'rb') as img_file:
-       # height of image (in 2 bytes) is at 164th position
-       img_file.seek(163)
-       # read the 2 bytes
-       a = img_file.read(2)
-       # calculate height
-       height = (a[0] << 8) + a[1]
-       # next 2 bytes is width
-       a = img_file.read(2)
-       # calculate width
-       width = (a[0] << 8) + a[1]
-
-   return width, height
+       # every jpeg starts with the SOI marker
+       if img_file.read(2) == b'\xff\xd8':
+           while True:
+               # find the next marker, skipping any 0xff fill bytes
+               b = img_file.read(1)
+               while b and b != b'\xff':
+                   b = img_file.read(1)
+               while b == b'\xff':
+                   b = img_file.read(1)
+               if not b:
+                   break
+               marker = b[0]
+               # standalone markers have no length field
+               if marker == 0x01 or 0xd0 <= marker <= 0xd7:
+                   continue
+               # EOI or start of scan before any frame header: give up
+               if marker in (0xd9, 0xda):
+                   break
+               seglen = img_file.read(2)
+               if len(seglen) < 2:
+                   break
+               seglen = struct.unpack('>H', seglen)[0]
+               # SOF0-SOF15, excluding DHT (c4), JPG (c8) and DAC (cc)
+               if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                   # skip the 1-byte sample precision, then height and width
+                   img_file.seek(1, 1)
+                   size = img_file.read(4)
+                   if len(size) < 4:
+                       break
+                   height, width = struct.unpack('>HH', size)
+                   return width, height
+               img_file.seek(seglen-2, 1)
+
+   print("ERROR reading jpeg size: {}".format(filename))
+   return 0, 0
 
 
@@ -8,6 +8,8 @@ Adjusted for wordpress-to-latex by R. L. Bailey (GitHub bairaelyn), April 2020.
 from lxml import etree
 from progressbar import ProgressBar, Percentage, Bar
 from dateutil import parser, tz
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 import re
 import unidecode
@@ -15,6 +17,7 @@ import datetime
 import pytz
 import requests
 import os
+import shutil
 import time
 import codecs
 
@@ -48,14 +51,24 @@ class Post:
         self.comments = []
 
     def adjust_paths(self, attachments=None, prefix=''):
-        if prefix is not '' and not prefix.endswith('/'):
+        if prefix != '' and not prefix.endswith('/'):
             print("[ERRR] Your attachment prefix does not end in a trailing slash")
             return False
-        if self.body is not None and attachments is not None:
-            for attachment in attachments:
-                if attachment.url in self.body:
-                    new_url = prefix + attachment.url.split('/')[-1]
-                    self.body = self.body.replace(attachment.url, new_url)
+        if self.body is not None and attachments:
+            urls = tuple(attachment.url for attachment in attachments if attachment.url)
+            if len(urls) > 0:
+                url_re, new_urls = _attachment_urls(urls, prefix)
+                self.body = url_re.sub(lambda m: new_urls[m.group(0)], self.body)
+
+
+@lru_cache(maxsize=8)
+def _attachment_urls(urls, prefix):
+    """Returns a regex matching any of the attachment urls, and a dict of url -> prefixed url.
+    Cached, as adjust_paths is called with the same attachments for every post."""
+    new_urls = {url: prefix + url.split('/')[-1] for url in urls}
+    # Longest first, so that a url is never cut short by another url it starts with:
+    url_re = re.compile('|'.join(re.escape(url) for url in sorted(new_urls, key=len, reverse=True)))
+    return url_re, new_urls
 
 
 class Attachment:
@@ -64,30 +77,72 @@ class Attachment:
         self.title = title
         self.url = url
 
-    def download(self, path='attachments'):
+    def download(self, path='attachments', session=None):
+        """Downloads the attachment into path. Pass a requests.Session to reuse its connections."""
         if self.url is not None:
             title = self.url.split('/')[-1]
-            attachment = requests.get(self.url)
-            if attachment.status_code == requests.codes.ok:
-                f = open(os.path.join(path, title), 'wb')
-                f.write(attachment.content)
-                f.close()
-            else:
-                attachment.raise_for_status()
+            # Streamed straight to disk, so large files are never held in memory whole:
+            with (session or requests).get(self.url, stream=True) as attachment:
+                if attachment.status_code == requests.codes.ok:
+                    attachment.raw.decode_content = True
+                    with open(os.path.join(path, title), 'wb') as f:
+                        shutil.copyfileobj(attachment.raw, f, 1<<16)
+                else:
+                    attachment.raise_for_status()
+
+
+def extract_blog_from_XML(filename, localtime="America/Chicago", published=True, download=True, keep_tree=False):
+    """Uses lxml.etree to parse the XML file and return as Python lists and objects (posts/attachments).
+
+    By default the file is read in a single lxml.etree.iterparse pass, and every item is freed
+    once it has been turned into a Post/Attachment, so large exports never sit in memory whole.
+    The returned tree is then None. Set keep_tree=True to parse the full tree instead and return it.
+    """
+    if keep_tree:
+        tree = etree.parse(filename)
+        namespaces = tree.getroot().nsmap
+
+        blogs = find_blog(tree)
+        authors = find_authors(tree, namespaces)
+        tags = find_tags(tree, namespaces)
+        posts = find_posts(tree, namespaces, localtime=localtime, published=published)
+        attachments = find_attachments(tree, namespaces, download=download)
 
+        return tree, namespaces, blogs, authors, tags, posts, attachments
 
-def extract_blog_from_XML(filename, localtime="America/Chicago", published=True, download=True):
-    """Uses lxml.etree to parse the XML file and return as Python lists and objects (posts/attachments)."""
-    tree = etree.parse(filename)
-    namespaces = tree.getroot().nsmap
+    namespaces = {}
+    local = pytz.timezone(localtime)
+    blogs, title = None, None
+    authors, tags, posts, attachments = [], [], [], []
+    for event, elem in etree.iterparse(filename, events=('start-ns', 'end')):
+        if event == 'start-ns':
+            prefix, uri = elem
+            namespaces.setdefault(prefix or None, uri)
+            continue
+        if elem.tag == 'item':
+            post_type = elem.findtext("./wp:post_type", namespaces=namespaces)
+            if post_type == 'post':
+                if not published or elem.findtext("./wp:status", namespaces=namespaces) == 'publish':
+                    posts.append(_post_from_elem(elem, namespaces, local))
+            elif post_type == 'attachment':
+                attachments.append(_attachment_from_elem(elem, namespaces))
+            _free_elem(elem)
+        elif elem.tag == '{%s}author' % namespaces.get('wp'):
+            authors.append(_author_from_elem(elem, namespaces))
+        elif elem.tag == '{%s}tag' % namespaces.get('wp'):
+            tags.append(_tag_from_elem(elem, namespaces))
+        elif elem.tag == 'title' and title is None and elem.getparent().tag == 'channel':
+            title = elem.text
+            print("Found %s" % title)
 
-    blogs = find_blog(tree)
-    authors = find_authors(tree, namespaces)
-    tags = find_tags(tree, namespaces)
-    posts = find_posts(tree, namespaces, localtime=localtime, published=published)
-    attachments = find_attachments(tree, namespaces, download=download)
+    authors = _found(authors, "authors")
+    tags = _found(tags, "tags")
+    posts = _found(posts, "posts")
+    attachments = _found(attachments, "attachments")
+    if attachments and download:
+        _download_attachments(attachments)
 
-    return tree, namespaces, blogs, authors, tags, posts, attachments
+    return None, namespaces, blogs, authors, tags, posts, attachments
 
 
 def find_blog(tree):
@@ -102,44 +157,16 @@ def find_blog(tree):
 
 def find_authors(tree, namespaces):
     author_elems = tree.findall(".//wp:author", namespaces=namespaces)
-    authors = []
-    for author_elem in author_elems:
-        login = author_elem.find("./wp:author_login", namespaces=namespaces)
-        email = author_elem.find("./wp:author_email", namespaces=namespaces)
-        username = author_elem.find("./wp:author_display_name", namespaces=namespaces)
-        first_name = author_elem.find("./wp:author_first_name", namespaces=namespaces)
-        last_name = author_elem.find("./wp:author_last_name", namespaces=namespaces)
-        authors.append({
-            'login': login,
-            'email': email,
-            'username': username,
-            'first_name': first_name,
-            'last_name': last_name
-        })
-    if len(authors) > 0:
-        print("Found %i authors" % len(authors))
-        return authors
-    else:
-        print("[WARN] Found no authors!")
-        return False
+    authors = [_author_from_elem(author_elem, namespaces) for author_elem in author_elems]
+
+    return _found(authors, "authors")
 
 
 def find_tags(tree, namespaces):
     tag_elems = tree.findall(".//wp:tag", namespaces=namespaces)
-    tags = []
-    for tag_elem in tag_elems:
-        slug = tag_elem.find("./wp:tag_slug", namespaces=namespaces)
-        name = tag_elem.find("./wp:tag_name", namespaces=namespaces)
-        tags.append({
-            'slug': slug,
-            'name': name
-        })
-    if len(tags) > 0:
-        print("Found %i tags" % len(tags))
-        return tags
-    else:
-        print("[WARN] Found no tags!")
-        return False
+    tags = [_tag_from_elem(tag_elem, namespaces) for tag_elem in tag_elems]
+
+    return _found(tags, "tags")
 
 
 def find_posts(tree, namespaces, localtime="America/Chicago", published=True):
@@ -148,60 +175,134 @@ def find_posts(tree, namespaces, localtime="America/Chicago", published=True):
         item_elems = tree.xpath(xpath, namespaces=namespaces)
     else:
         item_elems = tree.findall(".//item[wp:post_type='post']", namespaces=namespaces)
-    posts = []
-    for post_elem in item_elems:
-        post = Post(post_elem.find("./wp:post_id", namespaces=namespaces).text, post_elem.find("./title").text)
-        post.url = post_elem.find("./link").text
-        post.body = post_elem.find("./content:encoded", namespaces=namespaces).text
-        post_stamp = parser.parse(post_elem.find("./wp:post_date_gmt", namespaces=namespaces).text)
-        local = pytz.timezone(localtime)
-        local_stamp = local.localize(post_stamp, is_dst=True)
-        utc_stamp = local_stamp.astimezone(pytz.utc)
-        post.post_date = utc_stamp
-        tag_elems = post_elem.xpath("./category[@domain='post_tag']")
-        tags = []
-        if tag_elems is not None:
-            for tag in tag_elems:
-                tags.append(tag.get('nicename'))
-        post.tags = tags
-        posts.append(post)
-
-    if len(posts) > 0:
-        print("Found %i posts" % len(posts))
-        return posts
-    else:
-        print("[WARN] Found no posts!")
-        return False
+    local = pytz.timezone(localtime)
+    posts = [_post_from_elem(post_elem, namespaces, local) for post_elem in item_elems]
+
+    return _found(posts, "posts")
 
 
 def find_attachments(tree, namespaces, download=True):
     xpath = ".//item[wp:post_type='attachment']"
     attachment_elems = tree.xpath(xpath, namespaces=namespaces)
-    attachments = []
-    for attachment_elem in attachment_elems:
-        attachment = Attachment(attachment_elem.find("./wp:post_id", namespaces=namespaces).text, attachment_elem.find("./title").text, attachment_elem.find("./wp:attachment_url", namespaces=namespaces).text)
-        attachments.append(attachment)
-
-
-    if len(attachments) > 0:
-        print("Found %i attachments" % len(attachments))
-        if download:
-            print("Downloading %i attachments" % len(attachments))
-            progress = ProgressBar(widgets=[Percentage(), Bar()], maxval=len(attachments)).start()
-            for i, attachment in enumerate(attachments):
-                attachment.download('attachments')
-                progress.update(i)
-            progress.finish()
-            print("Downloaded %i attachments" % len(attachments))
-        return attachments
+    attachments = [_attachment_from_elem(attachment_elem, namespaces) for attachment_elem in attachment_elems]
+
+    attachments = _found(attachments, "attachments")
+    if attachments and download:
+        _download_attachments(attachments)
+    return attachments
+
+
+def _author_from_elem(author_elem, namespaces):
+    login = author_elem.find("./wp:author_login", namespaces=namespaces)
+    email = author_elem.find("./wp:author_email", namespaces=namespaces)
+    username = author_elem.find("./wp:author_display_name", namespaces=namespaces)
+    first_name = author_elem.find("./wp:author_first_name", namespaces=namespaces)
+    last_name = author_elem.find("./wp:author_last_name", namespaces=namespaces)
+    return {
+        'login': login,
+        'email': email,
+        'username': username,
+        'first_name': first_name,
+        'last_name': last_name
+    }
+
+
+def _tag_from_elem(tag_elem, namespaces):
+    slug = tag_elem.find("./wp:tag_slug", namespaces=namespaces)
+    name = tag_elem.find("./wp:tag_name", namespaces=namespaces)
+    return {
+        'slug': slug,
+        'name': name
+    }
+
+
+def _post_from_elem(post_elem, namespaces, local):
+    """Builds a Post from an item element, local is the pytz timezone of the post dates."""
+    # One pass over the item's children, keeping the first child of each tag:
+    children, tags = {}, []
+    for child in post_elem:
+        children.setdefault(child.tag, child)
+        if child.tag == 'category' and child.get('domain') == 'post_tag':
+            tags.append(child.get('nicename'))
+    wp = '{%s}' % namespaces['wp']
+    post = Post(children[wp+'post_id'].text, children['title'].text)
+    post.url = children['link'].text
+    post.body = children['{%s}encoded' % namespaces['content']].text
+    post_date = children[wp+'post_date_gmt'].text
+    # WordPress writes 'YYYY-MM-DD HH:MM:SS', only fall back to dateutil for anything else:
+    try:
+        post_stamp = datetime.datetime.fromisoformat(post_date)
+    except ValueError:
+        post_stamp = parser.parse(post_date)
+    post.post_date = local.localize(post_stamp, is_dst=True).astimezone(pytz.utc)
+    post.tags = tags
+    return post
+
+
+def _attachment_from_elem(attachment_elem, namespaces):
+    children = {}
+    for child in attachment_elem:
+        children.setdefault(child.tag, child)
+    wp = '{%s}' % namespaces['wp']
+    return Attachment(children[wp+'post_id'].text, children['title'].text, children[wp+'attachment_url'].text)
+
+
+def _found(items, name):
+    """Reports how many items were found, returns them or False if there are none."""
+    if len(items) > 0:
+        print("Found %i %s" % (len(items), name))
+        return items
     else:
-        print("[WARN] Found no attachments!")
+        print("[WARN] Found no %s!" % name)
         return False
 
 
+def _download_attachments(attachments, max_workers=16):
+    """Downloads attachments in parallel threads, as each download mostly waits on the network.
+    Attachments saved under the same file name are downloaded one after another in a single
+    thread, in their original order, so the last one wins and no file is written twice at once.
+    """
+    print("Downloading %i attachments" % len(attachments))
+    progress = ProgressBar(widgets=[Percentage(), Bar()], maxval=len(attachments)).start()
+
+    same_title = {}
+    for attachment in attachments:
+        title = attachment.url.split('/')[-1] if attachment.url is not None else None
+        same_title.setdefault(title, []).append(attachment)
+
+    def download_all(group):
+        for attachment in group:
+            attachment.download('attachments', session=session)
+        return len(group)
+
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # One pooled connection per thread, the default pool only keeps 10:
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        done = 0
+        for n in executor.map(download_all, same_title.values()):
+            done += n
+            progress.update(done)
+    progress.finish()
+    print("Downloaded %i attachments" % len(attachments))
+
+
+def _free_elem(elem):
+    """Frees a fully processed element during iterparse, and any siblings before it."""
+    elem.clear()
+    while elem.getprevious() is not None:
+        del elem.getparent()[0]
+
+
+_SLUG_RE = re.compile(r'\W+')
+
+
 def slugify(string):
     if string is not None:
-        string = unidecode.unidecode(string).lower()
-        return re.sub(r'\W+', '-', string)
+        # unidecode leaves ASCII unchanged, so only non-ASCII titles need it:
+        if not string.isascii():
+            string = unidecode.unidecode(string)
+        return _SLUG_RE.sub('-', string.lower())
     else:
         return ""